@@ -5,14 +5,21 @@ Support for working with the OpenNLP format and PoolParty.
 import os
 from os.path import basename, join as joinpath
 import sys
-from glob import iglob
 from itertools import zip_longest
+from collections import deque
 import re
+import functools
+import threading
 
 from pp_api import ppextract2matches, remove_overlaps
 
 from extract_concepts import clean_input  # extract_concepts depends on pp_api
 
+from .scanglob import iterfiles
+
+
+_PARA_SPLIT_RE = re.compile(r"(\n\s*\n[ \t]*|\n[ \t]+)")
+
 
 # Just raise an AssertionError for now
 class OpenNLPError(AssertionError):
@@ -30,6 +37,32 @@ class OpenNLPError(AssertionError):
 #     return "\n".join(wrapper.fill(line).replace(" \n", "\n").replace("\n ", "\n") for line in source)
 
 
+# Only texts up to this length are memoized (see `_memoize_short`)
+_MEMO_MAXLEN = 1000
+
+
+def _memoize_short(func):
+    """
+    Cache the results of a text function, but only for short texts such as
+    headers and footers that callers pass in repeatedly. Long documents are
+    rarely repeated and should not be kept alive by the cache.
+    (`process_folder` does not use the wrapped functions.)
+    """
+
+    cached = functools.lru_cache(maxsize=4096)(func)
+
+    @functools.wraps(func)
+    def wrapper(text, *args, **kwargs):
+        if len(text) <= _MEMO_MAXLEN:
+            return cached(text, *args, **kwargs)
+        return func(text, *args, **kwargs)
+
+    wrapper.cache_info = cached.cache_info
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+
+@_memoize_short
 def wraplines(text, width=80):
     """
     Wrap text, respecting existing newlines and character offsets.
@@ -45,26 +78,30 @@ def wraplines(text, width=80):
             new.append(line)
             continue
 
-        # While the line should and can be broken:
-        while len(line) > width and " " in line:
+        # Walk along the line with a cursor instead of re-slicing the remainder
+        start = 0
+        # While the rest of the line should be broken:
+        while len(line) - start > width:
             # Wrap at the rightmost available space
-            cut = line.rfind(" ", 0, width)
+            cut = line.rfind(" ", start, start+width)
             if cut == -1:
                 # else just wrap at the first opportunity
-                cut = line.find(" ")
+                cut = line.find(" ", start)
+                if cut == -1:
+                    break  # No spaces left, so it cannot be broken
 
-            # We KNOW there was a space, so `cut` is set
-            new.append(line[:cut])
-            line = line[cut+1:]
+            new.append(line[start:cut])
+            start = cut + 1
 
         # Any remaining content cannot or should not be broken: Ship it whole
         # (But not if the last wrap left nothing behind)
-        if line:
-            new.append(line)
+        if start < len(line):
+            new.append(line[start:])
 
     return "\n".join(new)
 
 
+@_memoize_short
 def longlines(text, collapse=False):
     """
     Remove newlines to turn each paragraph into a single logical line, as
@@ -101,16 +138,18 @@ def _iterlonglines(text, collapse=False):
     :param collapse:
     :return:
     """
-    chunks = iter(re.split(r"(\n\s*\n[ \t]*|\n[ \t]+)", text))
+    chunks = iter(_PARA_SPLIT_RE.split(text))
     for line in chunks:
         # Unfold
         oneline = line.replace("\n", " ")
         # Collapse internal whitespace (if requested)
         if collapse:
-            oneline = re.sub(r"\s+", " ", oneline.strip())
+            oneline = " ".join(oneline.split())
         yield oneline
 
-        linebreak = next(chunks)
+        linebreak = next(chunks, None)
+        if linebreak is None:  # The split always ends with a line
+            break
         # print("Line:", line, "\nBreak:", repr(linebreak))
         yield "\n" if collapse else linebreak
 
@@ -120,6 +159,11 @@ def _iterlonglines(text, collapse=False):
 # The set of printable ascii characters
 _asciirange = set(chr(n) for n in range(ord(" "), ord("~")+1))
 
+# Case-folding and non-breaking space removal for `ascii_equal`
+_ASCII_EQUAL_TRMAP = "".maketrans("\xa0ABCDEFGHIJKLMNOPQRSTUVWXYZ", " abcdefghijklmnopqrstuvwxyz")
+# The same for pure ascii strings, which have no non-breaking spaces
+_ASCII_EQUAL_BYTEMAP = bytes.maketrans(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ", b"abcdefghijklmnopqrstuvwxyz")
+
 
 def ascii_equal(left, right):
     """
@@ -128,16 +172,25 @@ def ascii_equal(left, right):
     (mis)matched.
     """
 
+    # The usual case: the strings are identical after folding.
+    # Translating bytes is much faster than str, so use it when we can.
+    if left.isascii() and right.isascii():
+        if (left.encode("ascii").translate(_ASCII_EQUAL_BYTEMAP)
+                == right.encode("ascii").translate(_ASCII_EQUAL_BYTEMAP)):
+            return True
+    left = left.translate(_ASCII_EQUAL_TRMAP)
+    right = right.translate(_ASCII_EQUAL_TRMAP)
+    if left == right:  # No need to pair up characters
+        return True
+
     # If a printable ascii character is paired to a non-ascii, just skip over.
     # Else compare (case-insensitive)
-    tr_map = "".maketrans("\xa0ABCDEFGHIJKLMNOPQRSTUVWXYZ", " abcdefghijklmnopqrstuvwxyz")
-
-    paired = zip_longest(left.translate(tr_map), right.translate(tr_map))
+    paired = zip_longest(left, right, fillvalue="")
     return not any((c1 in _asciirange) == (c2 in _asciirange) and c1 != c2
                     for c1, c2 in paired)
 
 
-def apply_edits(text, edits, endtag=" <END> "):
+def apply_edits(text, edits, endtag=" <END> ", *, presorted=False):
     """
     Annotate `text` in the OpenAPI style. `edits` is a list of 4-tuples
     describing the annotations.
@@ -154,14 +207,33 @@ def apply_edits(text, edits, endtag=" <END> "):
             tag:   The tag to annotate with
             content: the text of the matched region, or None to suppress checking
     :param endtag: string
+    :param presorted: True if `edits` are known to be increasing and non-overlapping.
+            Skips `remove_overlaps`; an out-of-order edit will raise an error
+            instead of being discarded.
 
     :return: the input text with inline annotations
     """
 
-    edits = remove_overlaps(edits)
+    return "".join(_iterapply_edits(text, edits, endtag, presorted=presorted))
+
+
+def _iterapply_edits(text, edits, endtag=" <END> ", *, presorted=False):
+    """
+    Implement `apply_edits`, yielding the annotated text piece by piece so that
+    it can be written out without being assembled first.
+    Returns an iterator. Errors are only raised when the offending edit is reached.
+    :param text:
+    :param edits:
+    :param endtag:
+    :param presorted:
+    :return:
+    """
+
+    if not presorted:
+        edits = remove_overlaps(edits)
 
     offset = 0
-    output = []
+    padded_tags = {}  # Usually all edits share the same tag
     for start, end, tag, match in edits:
         if start < offset:
             # Edit spans must be non-overlapping and increasing
@@ -172,7 +244,9 @@ def apply_edits(text, edits, endtag=" <END> "):
                 'Span {start}..{end} extends past the end of the input (length {maxlen})!'.format(**locals()))
 
         end += 1      # Convert to a Python range end
-        tag = " "+tag.strip()+" "
+        padded = padded_tags.get(tag)
+        if padded is None:
+            padded = padded_tags[tag] = " "+tag.strip()+" "
 
         content = text[start:end]
         if match and not ascii_equal(content.replace("\n", " "), match):
@@ -181,15 +255,66 @@ def apply_edits(text, edits, endtag=" <END> "):
             end -= 1  # set back to what was in the input
             raise OpenNLPError('Span {start}..{end} is "{content}", expected "{match}"!'.format(**locals()))
 
-        output.append(text[offset:start])   # Untagged text
-        output.append(tag+content+endtag)   # Tagged text span
+        yield text[offset:start]        # Untagged text
+        yield padded+content+endtag     # Tagged text span
         offset = end
 
-    output.append(text[offset:])
-    return ''.join(output)
+    yield text[offset:]
+
+
+def _process_one(task):
+    """
+    Run a single file through the extractor for `process_folder`. Errors that
+    should only cause the file to be skipped are returned instead of raised.
+    This is a module-level function so that it can be sent to worker processes.
+    :param task: tuple (worker, tag, fname, plaintext, encoding), as for `process_file`
+    :return: tuple (extracted, error), one of which is None. `extracted` is
+            a tuple (base_text, edits) to be passed to `apply_edits`
+    """
+
+    worker, tag, fname, plaintext, encoding = task
+    try:
+        return _extract(worker, tag, fname, plaintext, encoding), None
+    except (OpenNLPError, TypeError) as error:
+        # A TypeError could be due to an extractor timeout,
+        # which is swallowed but causes the worker to return None
+        return None, error
+
+
+def _windowed_map(executor, func, iterable, window):
+    """
+    Like `executor.map(func, iterable)`, but with at most `window` tasks
+    submitted and not yet consumed. Unlike `map`, results that finish early
+    cannot pile up in memory while an earlier, slow task is still running.
+    Returns an iterator
+    :param executor: A `concurrent.futures` executor
+    :param func:
+    :param iterable:
+    :param window: Maximum number of tasks in flight
+    :return:
+    """
+
+    pending = deque()
+    try:
+        for item in iterable:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # If the caller stops early, don't leave queued work behind
+        for future in pending:
+            future.cancel()
+
+
+def _report_skipped(fname, error):
+    print("In file {}:\n".format(fname), error, file=sys.stderr)
+    print("SKIPPING...\n", file=sys.stderr)
 
 
-def process_folder(worker, tag, inpath, outpath, fileglob="**", *, plaintext=False, encoding="utf8", progress=False):
+def process_folder(worker, tag, inpath, outpath, fileglob="**", *, plaintext=False, encoding="utf8", progress=False,
+                   executor=None, window=16):
     """
     Create an annotated corpus in OpenNLP syntax from all files in the
     folder `inpath`, or subfolders, that match the pattern `fileglob`
@@ -207,6 +332,13 @@ def process_folder(worker, tag, inpath, outpath, fileglob="**", *, plaintext=Fal
     :param plaintext: True if only text files will be processed (allows text format to be preserved)
     :param encoding: File encoding for input (if plaintext) and output.
     :param progress: Print a dot after processing each file, as a progress indicator
+    :param executor: A `concurrent.futures` executor for annotating several files
+            at once. Use a ThreadPoolExecutor if the extractor is a server
+            (the usual case); a ProcessPoolExecutor requires a picklable `worker`.
+            By default, files are processed one at a time.
+    :param window: With an `executor`, the maximum number of files being processed
+            or waiting to be written at any time. Should be at least the number
+            of workers, so that none of them sits idle.
     :return:
     """
 
@@ -217,8 +349,21 @@ def process_folder(worker, tag, inpath, outpath, fileglob="**", *, plaintext=Fal
     if inpath.endswith(os.path.sep) and len(inpath) > 1:
         inpath = inpath[:-1]
 
-    for fname in iglob(joinpath(inpath, fileglob), recursive=True):
-        if not os.path.isfile(fname):
+    tasks = [(worker, tag, fname, plaintext, encoding) for fname in iterfiles(inpath, fileglob)]
+    if executor is None:
+        results = map(_process_one, tasks)
+    else:
+        results = _windowed_map(executor, _process_one, tasks, window)
+
+    # Annotated files are written to a scratch file first (see below)
+    os.makedirs(outpath, exist_ok=True)
+    tmpfile = joinpath(outpath, ".onlp-{}-{}.tmp".format(os.getpid(), threading.get_ident()))
+    created = set()  # Output folders known to exist
+
+    # Results arrive in order; all writing is done here
+    for (_, _, fname, _, _), (extracted, error) in zip(tasks, results):
+        if error is not None:
+            _report_skipped(fname, error)
             continue
 
         # Destination in result folder
@@ -226,19 +371,28 @@ def process_folder(worker, tag, inpath, outpath, fileglob="**", *, plaintext=Fal
         samepath = fname[len(inpath)+1:] + ".onlp"
         outfile = joinpath(outpath, samepath)
 
+        # Stream the annotated text to the scratch file instead of joining it first.
+        # Bad edits are only detected along the way, so `outfile` (and its folder)
+        # is only touched once the whole file has been written.
+        base_text, edits = extracted
         try:
-            annotated = process_file(worker, tag, fname, plaintext, encoding)
+            with open(tmpfile, "w", encoding=encoding) as fpout:
+                fpout.writelines(_iterapply_edits(base_text, edits))
+
+            outdir = os.path.dirname(outfile)
+            if outdir not in created:
+                os.makedirs(outdir, exist_ok=True)
+                created.add(outdir)
+            os.replace(tmpfile, outfile)
         except (OpenNLPError, TypeError) as error:
-            # A TypeError could be due to an extractor timeout,
-            # which is swallowed but causes the worker to return None
-            print("In file {}:\n".format(fname), error, file=sys.stderr)
-            print("SKIPPING...\n", file=sys.stderr)
+            # Same errors as in `_process_one`: skip the file
+            os.remove(tmpfile)
+            _report_skipped(fname, error)
             continue
-
-
-        os.makedirs(os.path.dirname(outfile), exist_ok=True)
-        with open(outfile, "w", encoding=encoding) as fpout:
-            fpout.write(annotated)
+        except BaseException:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
 
         if progress:
             print(".", end="", flush=True)
@@ -251,12 +405,15 @@ def process_folder(worker, tag, inpath, outpath, fileglob="**", *, plaintext=Fal
 def diagnose(left, right):
     """Find and inspect the mismatch"""
 
-    from itertools import zip_longest
-
-    mismatches = [ (n, a, b) for n, (a,b)
-                   in enumerate(zip_longest(left, right, fillvalue="")) if not ascii_equal(a, b) ]
+    # Fold both strings once, then apply the `ascii_equal` test to each pair
+    paired = zip_longest(left.translate(_ASCII_EQUAL_TRMAP), right.translate(_ASCII_EQUAL_TRMAP), fillvalue="")
+    mismatches = (n for n, (c1, c2) in enumerate(paired)
+                  if (c1 in _asciirange) == (c2 in _asciirange) and c1 != c2)
 
-    n, a, b = mismatches[0]
+    n = next(mismatches, None)
+    if n is None:
+        return  # The only differences involve non-ascii characters
+    a, b = left[n:n+1], right[n:n+1]
     print("MISMATCH:", n, repr(a), repr(b))
     offset = max(n-3, 0)
     print("Left:", repr(left[offset:offset+28]))
@@ -274,24 +431,7 @@ def loose_match(left, right):
     :return:
     """
 
-    paired = zip_longest(left.translate(tr_map), right.translate(tr_map), fillvalue="")
-    return not any(c1 != c2 for c1, c2 in paired)
-
-
-def ascii_equal(left, right):
-        """
-        Compare two strings, one of which may have been dumbed down to ascii or
-        near-ascii. Space is included but newline is not, so the two can be freely
-        (mis)matched.
-        """
-
-        # If a printable ascii character is paired to a non-ascii, just skip over.
-        # Else compare (case-insensitive)
-        tr_map = "".maketrans("\xa0ABCDEFGHIJKLMNOPQRSTUVWXYZ", " abcdefghijklmnopqrstuvwxyz")
-
-        paired = zip_longest(left.translate(tr_map), right.translate(tr_map), fillvalue="")
-        return not any((c1 in _asciirange) == (c2 in _asciirange) and c1 != c2
-                       for c1, c2 in paired)
+    return left.translate(tr_map) == right.translate(tr_map)
 
 
 def process_file(worker, tag, fname, plaintext=False, encoding="utf8"):
@@ -306,6 +446,19 @@ def process_file(worker, tag, fname, plaintext=False, encoding="utf8"):
     :return:
     """
 
+    base_text, edits = _extract(worker, tag, fname, plaintext, encoding)
+    annotated = apply_edits(base_text, edits)
+
+    return annotated
+
+
+def _extract(worker, tag, fname, plaintext=False, encoding="utf8"):
+    """
+    Run a document through the extractor and convert the results to edits
+    for `apply_edits`. Arguments as for `process_file`.
+    :return: tuple (base_text, edits)
+    """
+
     # For plaintext files, preserve linebreaks if we can
     if plaintext:
         with open(fname, encoding=encoding) as fp:
@@ -319,7 +472,8 @@ def process_file(worker, tag, fname, plaintext=False, encoding="utf8"):
 
         # Substitute our own version of the text, if equivalent
         #-- if ascii_equal(base_text.lower(), cleaned.lower().replace("\n", " ")):
-        if loose_match(base_text, cleaned):
+        # (Cheap exact check first: the extractor may return its input unchanged)
+        if base_text == clean_utf or loose_match(base_text, cleaned):
             base_text = cleaned
         else:
             print("\n{fname}: Cannot match extractor text with original (dropping newlines)".format(fname=fname))
@@ -328,7 +482,6 @@ def process_file(worker, tag, fname, plaintext=False, encoding="utf8"):
         concepts, base_text = worker(fname)
 
     # restructure the results and insert as OpenNLP annotations
-    edits = ppextract2matches(concepts, tag=tag, overlaps=False)
-    annotated = apply_edits(base_text, edits)
+    edits = list(ppextract2matches(concepts, tag=tag, overlaps=False))
 
-    return annotated
+    return base_text, edits
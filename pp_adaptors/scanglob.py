@@ -0,0 +1,77 @@
+"""
+Recursive file globbing on top of `os.scandir`.
+"""
+
+import os
+from fnmatch import fnmatch
+
+
+def iterfiles(inpath, fileglob="**"):
+    """
+    Find the files in `inpath` whose path relative to it matches `fileglob`,
+    like `iglob(joinpath(inpath, fileglob), recursive=True)` restricted to files.
+    As with `iglob`, a hidden (dot) entry is only matched by a pattern part
+    that itself starts with a dot, never by "**"; "." parts are ignored.
+    Unlike `iglob`, each file is reported once, even for patterns like "**/**".
+    Subfolders that cannot be listed are skipped, as by `iglob`.
+
+    The walk uses `os.scandir`, so file types come with the directory listing
+    and are not looked up again for each match. Folders that cannot lead to
+    a match are not visited.
+    Returns an iterator
+    :param inpath: Folder to search
+    :param fileglob: Pattern relative to `inpath`; "**" matches any number of folders
+    :return:
+    """
+    patterns = [part for part in fileglob.replace(os.sep, "/").split("/") if part not in ("", ".")]
+    final = len(patterns)
+
+    # Match paths with a small NFA: a state is an index into `patterns`,
+    # and a "**" can also be skipped without consuming anything.
+    def closure(states):
+        result = set()
+        for n in states:
+            result.add(n)
+            while n < final and patterns[n] == "**":
+                n += 1
+                result.add(n)
+        return result
+
+    def advance(states, name):
+        hidden = name.startswith(".")
+        reached = []
+        for n in states:
+            if n == final:
+                continue
+            pattern = patterns[n]
+            if hidden and (pattern == "**" or not pattern.startswith(".")):
+                continue
+            if pattern == "**":
+                reached.append(n)
+            elif fnmatch(name, pattern):
+                reached.append(n+1)
+        return closure(reached)
+
+    pending = [(inpath, closure([0]))]
+    while pending:
+        folder, states = pending.pop()
+        try:
+            with os.scandir(folder) as entries:
+                entries = list(entries)
+        except OSError:
+            # Like `iglob`, skip subfolders that cannot be read (or have vanished);
+            # but a bad `inpath` is the caller's error.
+            if folder == inpath:
+                raise
+            continue
+
+        for entry in entries:
+            reached = advance(states, entry.name)
+            try:
+                if entry.is_dir():
+                    if any(n < final for n in reached):
+                        pending.append((entry.path, reached))
+                elif final in reached and entry.is_file():
+                    yield entry.path
+            except OSError:
+                continue
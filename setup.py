@@ -3,8 +3,9 @@ import setuptools
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
-dependencies = ["git://github.com/alexisdimi/pp_adaptors.git#egg=pp_adaptors"]
-    
+# pp_api on PyPI is an unrelated package: install the PoolParty one from git
+dependencies = ["pp_api @ git+https://github.com/semantic-web-company/pp_api.git"]
+
 setuptools.setup(
     name="pp_adaptors",
     version="0.0.1",
@@ -15,10 +16,11 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/alexisdimi/pp_adaptors",
     packages=["pp_adaptors"],
+    python_requires=">=3.7",
     license="MIT",
     classifiers=[
         "Programming Language :: Python :: 3",
         "Operating System :: OS Independent",
     ],
-    dependency_links=dependencies,
+    install_requires=dependencies,
 )
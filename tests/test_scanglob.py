@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+from glob import iglob
+from unittest import mock
+from os.path import join as joinpath
+
+from pp_adaptors.scanglob import iterfiles
+
+
+TREE = [
+    "x.txt", "y.md", ".dot.txt",
+    "a/z.txt", "a/b/w.txt", "a/b/v.md", "a/.hid/h.txt",
+    "c/u.txt",
+    ".hid/q.txt", ".hid/deeper/r.txt",
+    "sub/.hid/s.txt", "sub/t.txt",
+]
+
+PATTERNS = [
+    "**", "*", "*.txt", "**/*.txt", "**/**/*.txt", "**/*",
+    "a/*.txt", "a/**", "a/**/*.md", "**/b/*", "*/*", "a/b/w.txt", "a/",
+    ".*", ".hid/*", ".hid/**", "sub/.hid/*", "**/.hid/*", "**/.*",
+    "./*.txt", "a/./b/*", "*/.hid/*.txt", "nomatch/*",
+]
+
+
+class IterFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name in TREE:
+            path = joinpath(self.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_matches_recursive_iglob(self):
+        for pattern in PATTERNS:
+            with self.subTest(pattern=pattern):
+                expected = set(os.path.normpath(f)
+                               for f in iglob(joinpath(self.root, pattern), recursive=True)
+                               if os.path.isfile(f))
+                found = list(iterfiles(self.root, pattern))
+                self.assertEqual(set(found), expected)
+
+    def test_unreadable_subfolder_is_skipped(self):
+        unreadable = joinpath(self.root, "a")
+        scandir = os.scandir
+
+        def failing_scandir(path="."):
+            if os.path.normpath(path) == unreadable:
+                raise PermissionError(13, "Permission denied", path)
+            return scandir(path)
+
+        with mock.patch("os.scandir", failing_scandir):
+            expected = set(f for f in iglob(joinpath(self.root, "**"), recursive=True)
+                           if os.path.isfile(f))
+            found = set(iterfiles(self.root, "**"))
+        self.assertEqual(found, expected)
+        self.assertIn(joinpath(self.root, "c", "u.txt"), found)
+        self.assertNotIn(joinpath(self.root, "a", "z.txt"), found)
+
+    def test_no_duplicates(self):
+        found = list(iterfiles(self.root, "**/**/*.txt"))
+        self.assertEqual(len(found), len(set(found)))
+
+    def test_missing_folder(self):
+        with self.assertRaises(FileNotFoundError):
+            list(iterfiles(joinpath(self.root, "missing")))
+
+
+if __name__ == "__main__":
+    unittest.main()